@@ -1,26 +1,100 @@
+import os
 import time
+import random
 import logging
+import threading
 import requests
-from typing import Dict, Optional
-from prometheus_client import CollectorRegistry, Gauge, push_to_gateway, generate_latest
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Iterable, Optional, Tuple
+from prometheus_client import CollectorRegistry, Gauge, push_to_gateway, generate_latest, multiprocess
 
 # Logging setup
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Prometheus metric names can't contain '.' or '-'; one translate pass
+# replaces both without the intermediate strings chained .replace() builds
+_NAME_TRANSLATE = str.maketrans({'.': '_', '-': '_'})
+
+
+class _FilteredMultiProcessView:
+    """Registry view over the multiprocess mmap files limited to known families.
+
+    The mmap dir is shared by every collector in the process tree (including
+    the API's HTTP request histograms), so pushes read through this view to
+    ship only the gauges this backend owns to the pushgateway.
+    """
+
+    def __init__(self, path, names):
+        self._path = path
+        self._names = names
+
+    def collect(self):
+        collector = multiprocess.MultiProcessCollector(None, path=self._path)
+        for family in collector.collect():
+            if family.name in self._names:
+                yield family
+
 class MetricsBackend:
     def __init__(self, prometheus_gateway_url: str, job_name: str = "metrics_simulator"):
         self.prometheus_gateway_url = prometheus_gateway_url
         self.job_name = job_name
         self.registry = CollectorRegistry()
+        # Under multi-worker gunicorn each worker writes gauge samples to
+        # mmap files in PROMETHEUS_MULTIPROC_DIR; the collector aggregates
+        # them so /metrics and pushes cover all workers, not just this one
+        self._multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
         self.metrics = {}
+        # apply_metrics runs on executor threads, so first-time registration
+        # is a check-then-act that needs serializing; steady-state hits on
+        # _by_raw_name never take the lock
+        self._registration_lock = threading.Lock()
+        if self._multiproc_dir:
+            multiprocess.MultiProcessCollector(self.registry)
+            self._push_registry = _FilteredMultiProcessView(self._multiproc_dir, self.metrics)
+            logger.info(f"📂 Multiprocess metrics enabled in {self._multiproc_dir}")
+        else:
+            self._push_registry = self.registry
+        # Gauges keyed by the metric name as submitted, so repeat applies of
+        # the same names skip sanitization and go straight to gauge.set()
+        self._by_raw_name = {}
+        # Persistent HTTP session with keep-alive so pushes reuse one socket
+        # instead of paying the TCP handshake each call
+        self._session = requests.Session()
+        self._session.mount('http://', HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(total=2, backoff_factor=0.2)
+        ))
+        # Separate keep-alive session for health probes: no retries, so a
+        # down pushgateway is reported after one failed attempt instead of
+        # three timeouts plus backoff
+        self._probe_session = requests.Session()
+        self._probe_session.mount('http://', HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=2,
+            max_retries=0
+        ))
         self._test_connectivity()
 
+    def _session_handler(self, url, method, timeout, headers, data):
+        """Custom push_to_gateway handler that routes through the shared session"""
+        def handle():
+            response = self._session.request(
+                method, url, data=data, headers=dict(headers), timeout=timeout
+            )
+            if response.status_code >= 400:
+                raise IOError(
+                    f"error talking to pushgateway: {response.status_code} {response.reason}"
+                )
+        return handle
+
     def _test_connectivity(self):
         """Test if we can reach the Prometheus pushgateway"""
         try:
             test_url = self.prometheus_gateway_url.replace(':9091', ':9091/metrics')
-            response = requests.get(test_url, timeout=5)
+            response = self._probe_session.get(test_url, timeout=5)
             if response.status_code == 200:
                 logger.info(f"✅ Connected to Prometheus pushgateway at {self.prometheus_gateway_url}")
             else:
@@ -29,43 +103,60 @@ class MetricsBackend:
             logger.error(f"❌ Cannot connect to pushgateway at {self.prometheus_gateway_url}: {e}")
             logger.info("💡 Make sure pushgateway service is running and accessible")
 
-    def apply_metrics(self, metrics_data: Dict[str, Dict], timestamp: Optional[str] = None):
-        if not isinstance(metrics_data, dict):
-            return False, "Invalid format: metrics must be a dictionary"
-
+    def apply_metrics(self, metrics: Iterable[Tuple[str, float, str]], timestamp: Optional[str] = None):
+        """Apply an iterable of (metric_name, value, unit) tuples and push them"""
         try:
-            for metric_name, metric_info in metrics_data.items():
-                value = metric_info.get("value")
-                unit = metric_info.get("unit", "")
-
-                if not isinstance(value, (int, float)):
-                    logger.warning(f"Skipping {metric_name}: value must be numeric")
-                    continue
-
-                clean_metric_name = metric_name.replace('.', '_').replace('-', '_')
-                
-                if clean_metric_name not in self.metrics:
-                    gauge = Gauge(
-                        clean_metric_name,
-                        f"Simulated metric: {metric_name} ({unit})" if unit else f"Simulated metric: {metric_name}",
-                        registry=self.registry
-                    )
-                    self.metrics[clean_metric_name] = gauge
-                else:
-                    gauge = self.metrics[clean_metric_name]
+            count = 0
+            # Checked once so a 50-metric batch doesn't build 50 log records
+            # nobody reads at the default INFO level
+            log_each = logger.isEnabledFor(logging.DEBUG)
+            for metric_name, value, unit in metrics:
+                gauge = self._by_raw_name.get(metric_name)
+
+                if gauge is None:
+                    clean_metric_name = metric_name.translate(_NAME_TRANSLATE)
+
+                    with self._registration_lock:
+                        gauge = self.metrics.get(clean_metric_name)
+                        if gauge is None:
+                            description = (
+                                f"Simulated metric: {metric_name} ({unit})" if unit
+                                else f"Simulated metric: {metric_name}"
+                            )
+                            if self._multiproc_dir:
+                                # Samples live in the mmap files; registering the
+                                # gauge on the scrape registry would double-count
+                                gauge = Gauge(
+                                    clean_metric_name,
+                                    description,
+                                    registry=None,
+                                    multiprocess_mode='livesum'
+                                )
+                            else:
+                                gauge = Gauge(
+                                    clean_metric_name,
+                                    description,
+                                    registry=self.registry
+                                )
+                            self.metrics[clean_metric_name] = gauge
+
+                        self._by_raw_name[metric_name] = gauge
 
                 gauge.set(value)
-                logger.info(f"📊 Metric set: {clean_metric_name} = {value} {unit}")
+                count += 1
+                if log_each:
+                    logger.debug(f"📊 Metric set: {metric_name} = {value} {unit}")
 
-            logger.info(f"🚀 Pushing {len(metrics_data)} metrics to {self.prometheus_gateway_url}")
+            logger.info(f"🚀 Pushing {count} metrics to {self.prometheus_gateway_url}")
             push_to_gateway(
                 gateway=self.prometheus_gateway_url,
                 job=self.job_name,
-                registry=self.registry
+                registry=self._push_registry,
+                handler=self._session_handler
             )
 
-            logger.info(f"✅ Successfully pushed {len(metrics_data)} metric(s) to Prometheus")
-            return True, f"{len(metrics_data)} metric(s) pushed to Prometheus"
+            logger.info(f"✅ Successfully pushed {count} metric(s) to Prometheus")
+            return True, f"{count} metric(s) pushed to Prometheus"
 
         except requests.exceptions.ConnectionError as e:
             error_msg = f"Cannot connect to Prometheus pushgateway at {self.prometheus_gateway_url}: {e}"
@@ -77,12 +168,12 @@ class MetricsBackend:
             return False, error_msg
 
     def get_metrics_output(self):
-        """Get the current metrics in Prometheus format"""
+        """Get the current metrics in Prometheus exposition format (bytes)"""
         try:
-            return generate_latest(self.registry).decode("utf-8")
+            return generate_latest(self.registry)
         except Exception as e:
             logger.error(f"Error generating metrics output: {e}")
-            return f"# Error generating metrics: {e}\n"
+            return f"# Error generating metrics: {e}\n".encode("utf-8")
 
     def get_status(self):
         """Get status information about the metrics backend"""
@@ -98,38 +189,40 @@ class MetricsBackend:
         """Check if the pushgateway is accessible"""
         try:
             test_url = self.prometheus_gateway_url.replace(':9091', ':9091/metrics')
-            response = requests.get(test_url, timeout=3)
+            response = self._probe_session.get(test_url, timeout=3)
             return response.status_code == 200
         except:
             return False
 
 # Simulator functionality
-def simulate_metrics(metrics_backend: MetricsBackend):
-    """Simulate realistic system metrics"""
-    import random
-    
-    base_memory = 134217728  # ~128MB
-    base_cpu = 1200.5
-    base_http_duration = 0.250
-    
-    sample_metrics = {
-        'process_memory_bytes': {
-            'value': base_memory + random.randint(-10000000, 20000000), 
-            'unit': 'bytes'
-        },
-        'cpu_seconds_total': {
-            'value': base_cpu + random.uniform(0, 10), 
-            'unit': 's'
-        },
-        'http_request_duration_seconds': {
-            'value': max(0.001, base_http_duration + random.uniform(-0.1, 0.2)), 
-            'unit': 's'
-        }
-    }
+_BASE_MEMORY = 134217728  # ~128MB
+_BASE_CPU = 1200.5
+_BASE_HTTP_DURATION = 0.250
+
+# Private generator so sampling doesn't go through the shared module-level
+# Random that random.randint/random.uniform dispatch to
+_rng = random.Random()
 
+# One [name, value, unit] entry per simulated metric, allocated once and
+# mutated in place each tick instead of rebuilding the structure
+_SAMPLE_BUFFER = [
+    ['process_memory_bytes', 0, 'bytes'],
+    ['cpu_seconds_total', 0.0, 's'],
+    ['http_request_duration_seconds', 0.0, 's'],
+]
+
+def sample_metrics():
+    """Fill and return one tick of simulated system metrics as (name, value, unit)"""
+    _SAMPLE_BUFFER[0][1] = _BASE_MEMORY + _rng.randint(-10000000, 20000000)
+    _SAMPLE_BUFFER[1][1] = _BASE_CPU + _rng.uniform(0, 10)
+    _SAMPLE_BUFFER[2][1] = max(0.001, _BASE_HTTP_DURATION + _rng.uniform(-0.1, 0.2))
+    return _SAMPLE_BUFFER
+
+def simulate_metrics(metrics_backend: MetricsBackend):
+    """Apply one tick of simulated metrics immediately"""
     logger.info("📊 Simulating metrics...")
-    success, result = metrics_backend.apply_metrics(sample_metrics)
-    
+    success, result = metrics_backend.apply_metrics(sample_metrics())
+
     if success:
         logger.info(f"✅ {result}")
     else:
@@ -138,28 +231,48 @@ def simulate_metrics(metrics_backend: MetricsBackend):
 def run_simulator():
     """Main simulator loop"""
     import os
-    
+
     # Configuration for simulator
     PROMETHEUS_GATEWAY_URL = os.getenv('PROMETHEUS_GATEWAY_URL', 'http://pushgateway-svc:9091')
     JOB_NAME = os.getenv('METRICS_JOB_NAME', 'metrics_simulator')
-    
+    # Ticks to accumulate locally before one batched pushgateway round-trip
+    PUSH_EVERY_TICKS = max(1, int(os.getenv('SIM_PUSH_EVERY_TICKS', 4)))
+
     logger.info(f"🚀 Starting metrics simulator with:")
     logger.info(f"   Prometheus Gateway: {PROMETHEUS_GATEWAY_URL}")
     logger.info(f"   Job Name: {JOB_NAME}")
-    
+
     metrics_backend = MetricsBackend(
         prometheus_gateway_url=PROMETHEUS_GATEWAY_URL,
         job_name=JOB_NAME
     )
-    
-    logger.info("🎯 Metrics simulator started - sending metrics every 30 seconds")
+
+    logger.info(f"🎯 Metrics simulator started - sampling every 30 seconds, "
+                f"pushing every {PUSH_EVERY_TICKS} tick(s)")
     logger.info("   Press Ctrl+C to stop")
-    
+
     try:
-        simulate_metrics(metrics_backend)
+        pending = {}
+        ticks = 0
         while True:
+            # Keep only the latest sample per metric; the pushgateway holds
+            # last-value state anyway, so intermediate ticks add no signal
+            for name, value, unit in sample_metrics():
+                pending[name] = (value, unit)
+            ticks += 1
+
+            if ticks % PUSH_EVERY_TICKS == 0:
+                logger.info(f"📊 Pushing batch of {len(pending)} metric(s)...")
+                success, result = metrics_backend.apply_metrics(
+                    [(name, value, unit) for name, (value, unit) in pending.items()]
+                )
+                if success:
+                    logger.info(f"✅ {result}")
+                else:
+                    logger.error(f"❌ {result}")
+                pending.clear()
+
             time.sleep(30)
-            simulate_metrics(metrics_backend)
     except KeyboardInterrupt:
         logger.info("🛑 Simulator stopped by user")
     except Exception as e:
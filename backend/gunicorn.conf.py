@@ -0,0 +1,35 @@
+"""Gunicorn configuration for multi-worker deployments.
+
+Launch with:
+    gunicorn -c gunicorn.conf.py main:app
+
+Set PROMETHEUS_MULTIPROC_DIR (e.g. /tmp/prom) so the Prometheus client
+aggregates gauges across workers instead of exposing one random worker.
+"""
+import multiprocessing
+import os
+
+bind = f"{os.getenv('FASTAPI_HOST', '0.0.0.0')}:{os.getenv('FASTAPI_PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def on_starting(server):
+    """Reset the multiprocess metrics dir before workers fork.
+
+    Gauge samples live in mmap files under PROMETHEUS_MULTIPROC_DIR; files
+    left over from a previous run would be aggregated into /metrics as if
+    those processes were still alive.
+    """
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for entry in os.listdir(multiproc_dir):
+            os.unlink(os.path.join(multiproc_dir, entry))
+
+
+def child_exit(server, worker):
+    """Drop a dead worker's mmap files so its gauges leave the aggregate."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,10 +1,15 @@
 import os
+import re
 import time
+import asyncio
 import logging
 from typing import Dict, Optional, List
 from fastapi import FastAPI, Request, HTTPException, status
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, validator
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
+from prometheus_fastapi_instrumentator import Instrumentator
+from pydantic import BaseModel, field_validator
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
@@ -18,9 +23,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Simple in-memory rate limiter
-limiter = Limiter(key_func=get_remote_address)
-
 # Configuration
 class Settings:
     PROMETHEUS_GATEWAY_URL = os.getenv('PROMETHEUS_GATEWAY_URL', 'http://pushgateway-svc:9091')
@@ -32,6 +34,7 @@ class Settings:
     NAMESPACE = os.getenv('NAMESPACE', 'birdseye')
 
     # Request limits
+    MAX_REQUEST_SIZE = int(os.getenv('MAX_REQUEST_SIZE', 1024 * 1024))
     MAX_METRICS_PER_REQUEST = int(os.getenv('MAX_METRICS_PER_REQUEST', 50))
     MAX_METRIC_VALUE = float(os.getenv('MAX_METRIC_VALUE', 1e15))
     MIN_METRIC_VALUE = float(os.getenv('MIN_METRIC_VALUE', -1e15))
@@ -42,14 +45,33 @@ class Settings:
     # Generous limits for non-sensitive endpoints
     GENERAL_REQUESTS_PER_MINUTE = int(os.getenv('GENERAL_REQUESTS_PER_MINUTE', 300))
 
+    # Shared rate-limit storage; point at Redis (redis://host:6379/0) when
+    # running more than one worker so counters are enforced cluster-wide
+    RATE_LIMIT_STORAGE_URI = os.getenv('RATE_LIMIT_STORAGE_URI', 'memory://')
+
 
 settings = Settings()
 
+# Rate limiter; in-memory storage is per-process, so multi-worker
+# deployments must set RATE_LIMIT_STORAGE_URI to a shared Redis instance
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=settings.RATE_LIMIT_STORAGE_URI,
+    strategy="fixed-window",
+)
+
+if settings.RATE_LIMIT_STORAGE_URI == 'memory://':
+    logger.warning(
+        "⚠️ Rate limiting uses in-process memory storage; "
+        "set RATE_LIMIT_STORAGE_URI=redis://... for multi-worker deployments"
+    )
+
 # FastAPI App Setup
 app = FastAPI(
     title="Metrics Simulator API",
     description="A simple API for simulating Prometheus metrics with strict Apply Changes rate limiting",
     version="2.1.1",
+    default_response_class=ORJSONResponse,
     docs_url="/docs" if settings.DEBUG else None,
     redoc_url="/redoc" if settings.DEBUG else None,
     openapi_url="/openapi.json" if settings.DEBUG else None
@@ -105,21 +127,24 @@ app.add_middleware(
     max_age=600,
 )
 
+# Compiled once at import; validators run this per metric name on every request
+METRIC_NAME_PATTERN = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+
 # Enhanced Pydantic Models
 class MetricPayload(BaseModel):
     value: float
     unit: Optional[str] = ""
     timestamp: Optional[int] = None
 
-    @validator('value')
+    @field_validator('value')
+    @classmethod
     def validate_value_range(cls, v):
-        if not isinstance(v, (int, float)):
-            raise ValueError('Value must be a number')
         if not (settings.MIN_METRIC_VALUE <= v <= settings.MAX_METRIC_VALUE):
             raise ValueError(f'Value must be between {settings.MIN_METRIC_VALUE} and {settings.MAX_METRIC_VALUE}')
-        return float(v)
+        return v
 
-    @validator('unit')
+    @field_validator('unit')
+    @classmethod
     def validate_unit(cls, v):
         if v is None:
             return ""
@@ -128,7 +153,8 @@ class MetricPayload(BaseModel):
             raise ValueError(f'Unit must be one of: {allowed_units}')
         return v
 
-    @validator('timestamp')
+    @field_validator('timestamp')
+    @classmethod
     def validate_timestamp(cls, v):
         if v is not None:
             current_time = int(time.time() * 1000)
@@ -141,24 +167,22 @@ class MetricsRequest(BaseModel):
     metrics: Dict[str, MetricPayload]
     timestamp: Optional[int] = None
 
-    @validator('metrics')
-    def validate_metrics_count(cls, v):
+    @field_validator('metrics')
+    @classmethod
+    def validate_metrics(cls, v):
+        # Count checks first so an oversized batch fails before any name work
         if len(v) == 0:
             raise ValueError('At least one metric is required')
         if len(v) > settings.MAX_METRICS_PER_REQUEST:
             raise ValueError(f'Too many metrics. Maximum allowed: {settings.MAX_METRICS_PER_REQUEST}')
-        return v
 
-    @validator('metrics')
-    def validate_metric_names(cls, v):
         for name in v.keys():
             if not name:
                 raise ValueError('Metric name cannot be empty')
             if len(name) > 200:
                 raise ValueError(f'Metric name too long (max 200 chars): {name}')
 
-            import re
-            if not re.match(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$', name):
+            if not METRIC_NAME_PATTERN.match(name):
                 raise ValueError(
                     f'Invalid metric name format: {name}. '
                     'Must start with letter/underscore and contain only letters, numbers, underscores, and colons.'
@@ -166,14 +190,28 @@ class MetricsRequest(BaseModel):
         return v
 
 
+# Headers that never vary per request, pre-encoded so they can be appended
+# to the raw header list without per-request hashing or encoding
+STATIC_SECURITY_HEADERS = {
+    "X-Content-Type-Options": "nosniff",
+    "X-Frame-Options": "DENY",
+    "X-XSS-Protection": "1; mode=block",
+    "Referrer-Policy": "strict-origin-when-cross-origin",
+}
+STATIC_SECURITY_HEADERS_RAW = [
+    (name.lower().encode("latin-1"), value.encode("latin-1"))
+    for name, value in STATIC_SECURITY_HEADERS.items()
+]
+
 # Security middleware with request tracking
 @app.middleware("http")
 async def security_middleware(request: Request, call_next):
     """Security middleware with Apply Changes tracking"""
     client_ip = get_remote_address(request)
 
-    # Request size limit
-    max_size = int(os.getenv('MAX_REQUEST_SIZE', 1024 * 1024))
+    # Request size limit; production also enforces this at the Traefik edge
+    # before the request reaches the app
+    max_size = settings.MAX_REQUEST_SIZE
     content_length = request.headers.get("content-length")
     if content_length:
         try:
@@ -185,24 +223,20 @@ async def security_middleware(request: Request, call_next):
             logger.warning(f"🚫 Invalid Content-Length from IP {client_ip}")
             raise HTTPException(status_code=400, detail="Invalid request")
 
-    # Track Apply Changes requests
-    if request.method == "POST" and "/api/metrics/apply" in str(request.url):
+    # Track Apply Changes requests (path match avoids formatting the full URL)
+    is_apply_changes = request.method == "POST" and request.url.path == "/api/metrics/apply"
+    if is_apply_changes:
         logger.info(f"🎯 Apply Changes request from IP: {client_ip}")
 
-    # Process request
-    start_time = time.time()
+    # Process request; latency is recorded by the instrumentator histograms,
+    # so the middleware no longer does its own timing
     response = await call_next(request)
-    process_time = time.time() - start_time
 
-    # Add security headers
-    response.headers["X-Content-Type-Options"] = "nosniff"
-    response.headers["X-Frame-Options"] = "DENY"
-    response.headers["X-XSS-Protection"] = "1; mode=block"
-    response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-    response.headers["X-Process-Time"] = f"{process_time:.4f}"
+    # Add security headers (raw append skips MutableHeaders hashing)
+    response.headers.raw.extend(STATIC_SECURITY_HEADERS_RAW)
 
     # Add rate limit info to Apply Changes responses
-    if request.method == "POST" and "/api/metrics/apply" in str(request.url) and response.status_code < 400:
+    if is_apply_changes and response.status_code < 400:
         response.headers["X-RateLimit-Limit"] = str(settings.APPLY_CHANGES_PER_15MINUTES)
         response.headers["X-RateLimit-Window"] = "900s (15 minutes)"
 
@@ -212,6 +246,21 @@ async def security_middleware(request: Request, call_next):
     return response
 
 
+# Request counters, in-progress gauges and latency histograms for every
+# route, kept in their own registry so they are scraped from /metrics but
+# never pushed to the pushgateway with the simulated gauges. In
+# multiprocess mode these samples land in the shared mmap dir too, so the
+# backend filters its pushes down to the gauges it owns
+http_metrics_registry = CollectorRegistry()
+Instrumentator(
+    should_group_status_codes=True,
+    # Anchored: entries are matched with re.search, so a bare "/metrics"
+    # would also exclude /api/metrics/apply
+    excluded_handlers=[r"^/metrics$"],
+    registry=http_metrics_registry,
+).instrument(app)
+
+
 # Initialize metrics backend
 try:
     metrics_backend = MetricsBackend(
@@ -251,7 +300,8 @@ async def health_check(request: Request):
 
     if metrics_backend:
         try:
-            backend_status = metrics_backend.get_status()
+            # get_status probes the pushgateway over HTTP; keep it off the loop
+            backend_status = await asyncio.to_thread(metrics_backend.get_status)
             health_status["prometheus_healthy"] = backend_status.get("healthy", False)
         except Exception as e:
             logger.error(f"Health check error: {e}")
@@ -268,7 +318,8 @@ async def api_status(request: Request):
         raise HTTPException(status_code=503, detail="Metrics backend not initialized")
 
     try:
-        status = metrics_backend.get_status()
+        # get_status probes the pushgateway over HTTP; keep it off the loop
+        status = await asyncio.to_thread(metrics_backend.get_status)
         status.update({
             "api_version": "2.1.1",
             "environment": settings.ENV,
@@ -295,8 +346,19 @@ async def prometheus_metrics(request: Request):
         raise HTTPException(status_code=503, detail="Metrics backend not initialized")
 
     try:
-        metrics_output = metrics_backend.get_metrics_output()
-        return {"metrics": metrics_output, "format": "prometheus"}
+        content = metrics_backend.get_metrics_output()
+        # In multiprocess mode the backend's collector already aggregates the
+        # instrumentator's mmap-backed samples; appending them again would
+        # duplicate the families
+        if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            content += generate_latest(http_metrics_registry)
+        # Set the header directly: passing CONTENT_TYPE_LATEST as media_type
+        # makes Starlette append a second "; charset=utf-8", which Prometheus
+        # rejects as an unparseable Content-Type
+        return Response(
+            content=content,
+            headers={"Content-Type": CONTENT_TYPE_LATEST}
+        )
     except Exception as e:
         logger.error(f"Metrics generation error: {e}")
         raise HTTPException(status_code=500, detail="Failed to generate metrics")
@@ -315,23 +377,28 @@ async def apply_metrics(request: Request, metrics_request: MetricsRequest):
 
     client_ip = get_remote_address(request)
     user_agent = request.headers.get("User-Agent", "Unknown")
+    # One clock read reused for the request log and the response timestamp
+    now = int(time.time())
 
     logger.info(
-        f"🎯 APPLY CHANGES REQUEST #{int(time.time())} - IP: {client_ip}, "
+        f"🎯 APPLY CHANGES REQUEST #{now} - IP: {client_ip}, "
         f"Metrics: {len(metrics_request.metrics)}, "
         f"User-Agent: {user_agent[:50]}..."
     )
 
     try:
-        metrics_data = {}
-        for name, metric in metrics_request.metrics.items():
-            metrics_data[name] = {
-                "value": metric.value,
-                "unit": metric.unit,
-                "timestamp": metric.timestamp or int(time.time() * 1000)
-            }
+        # Single lazy pass over the validated batch; the backend consumes
+        # (name, value, unit) tuples directly, so the Pydantic models are
+        # the only per-metric objects that ever exist
+        metrics_data = (
+            (name, metric.value, metric.unit)
+            for name, metric in metrics_request.metrics.items()
+        )
 
-        success, message = metrics_backend.apply_metrics(
+        # The pushgateway round-trip is blocking I/O; run it in a worker
+        # thread so the event loop keeps serving other requests during the RTT
+        success, message = await asyncio.to_thread(
+            metrics_backend.apply_metrics,
             metrics_data,
             timestamp=metrics_request.timestamp
         )
@@ -346,7 +413,7 @@ async def apply_metrics(request: Request, metrics_request: MetricsRequest):
             "success": True,
             "message": message,
             "metrics_count": len(metrics_request.metrics),
-            "timestamp": int(time.time()),
+            "timestamp": now,
             "rate_limit_info": {
                 "limit": f"{settings.APPLY_CHANGES_PER_15MINUTES} per 15 minutes",
                 "window": "900 seconds",
@@ -417,6 +484,8 @@ if __name__ == "__main__":
         app,
         host=settings.HOST,
         port=settings.PORT,
+        loop="uvloop",
+        http="httptools",
         access_log=settings.DEBUG,
         log_level="info" if settings.DEBUG else "warning"
     )
\ No newline at end of file